@@ -1,15 +1,32 @@
-from dotenv import load_dotenv
 import os
-import json
+import orjson
 import argparse
+import asyncio
+import functools
+import hashlib
+import io
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime
-from ibm_watson import NaturalLanguageUnderstandingV1
-from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
-import ibm_watson.natural_language_understanding_v1 as nlu1
 
-load_dotenv()
+# the IBM SDK, urllib3 and dotenv are imported where they are first needed, so that
+# --help and argument errors don't wait for them to load
 
 EMOTIONS = ["joy", "sadness", "anger", "fear", "disgust"]
+EMOTIONS_PADDED = [e.ljust(7) for e in EMOTIONS]
+API_VERSION = "2022-04-07"
+MAX_WORKERS = 8  # maximum number of API requests in flight at once, one per thread
+OUT_FILE = "out.jsonl"  # results are appended here, one line per input
+CACHE_FILE = "cache.sqlite"  # where results are stored to avoid repeating API calls
+BATCH_SEPARATOR = "\n\n###LINE###\n\n"  # placed between lines sent in the same API call
+
+# held while printing so that output from concurrent analyses is not interleaved
+_print_lock = threading.Lock()
+# held while accessing the result cache, which is shared between threads
+_cache_lock = threading.Lock()
 
 
 def init_model(api_key=None, api_url=None):
@@ -24,7 +41,14 @@ def init_model(api_key=None, api_url=None):
     :return: An initialised connection object
     :rtype: class:`ibm_watson.NaturalLanguageUnderstandingV1`
     """
+    from dotenv import load_dotenv
+    from ibm_watson import NaturalLanguageUnderstandingV1
+    from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
+    from ibm_cloud_sdk_core.http_adapter import SSLHTTPAdapter
+    from urllib3.util.retry import Retry
+
     # reading environment variables
+    load_dotenv()
     if api_key is None:
         api_key = os.getenv("IBM_NLU_API_KEY")
     if api_url is None:
@@ -32,12 +56,68 @@ def init_model(api_key=None, api_url=None):
 
     # creating the connection
     auth = IAMAuthenticator(api_key)
-    model = NaturalLanguageUnderstandingV1(version="2022-04-07", authenticator=auth)
+    model = NaturalLanguageUnderstandingV1(version=API_VERSION, authenticator=auth)
     model.set_service_url(api_url)
 
+    # reusing connections across calls (and threads) to avoid repeated TLS handshakes;
+    # the SDK's adapter is kept so its TLS settings still apply
+    model.http_adapter = SSLHTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 502, 503, 504],
+            # the analyse endpoint is a POST, which is not retried by default
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"},
+        ),
+        _disable_ssl_verification=model.disable_ssl_verification,
+    )
+    model.http_client.mount("http://", model.http_adapter)
+    model.http_client.mount("https://", model.http_adapter)
+
     return model
 
 
+def open_cache(path=CACHE_FILE):
+    """Opens (creating if necessary) the on-disk cache of previous analysis results.
+
+    :param path: Path of the SQLite database file, defaults to CACHE_FILE
+    :type path: str, optional
+
+    :return: A connection to the cache, which may be shared between threads
+    :rtype: class:`sqlite3.Connection`
+    """
+    cache = sqlite3.connect(path, check_same_thread=False)
+    cache.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, json TEXT)")
+    cache.commit()
+    return cache
+
+
+def _cache_key(text, targets, language):
+    """Builds the cache key for an analysis; the order of the targets does not matter."""
+    # encoding as a JSON list so that no two different inputs give the same string;
+    # the API version is included so that results from an older version aren't reused
+    raw = orjson.dumps([API_VERSION, language, text, sorted(targets)])
+    return hashlib.sha256(raw).hexdigest()
+
+
+def _iter_clean(path):
+    """Reads a file line by line, skipping blank lines and comments (lines starting with `#`).
+
+    :param path: Path of the file to read
+    :type path: str
+
+    :return: The remaining lines, with surrounding whitespace removed
+    :rtype: Iterator[str]
+    """
+    with open(path) as f:
+        for line in f:
+            s = line.strip()
+            if s and not s.startswith("#"):
+                yield s
+
+
 def main():
     """Main function; parses command-line arguments, reads in input text, and calls the API to analyse it."""
     # argument parsing
@@ -72,7 +152,27 @@ def main():
         "-n",
         "--no-save",
         action="store_true",
-        help="Do not save the results to the out.json file.",
+        help=f"Do not save the results to the {OUT_FILE} file.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help=f"Always call the API, rather than reusing results stored in {CACHE_FILE}.",
+    )
+    parser.add_argument(
+        "-d",
+        "--direct",
+        action="store_true",
+        help="Call the REST endpoint directly rather than through the IBM Watson SDK, which is faster for large batches.",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        type=int,
+        default=1,
+        help="Maximum number of lines with the same targets to send in a single API call. "
+        "When greater than 1, usage and document scores are for the whole batch and each target's "
+        "scores are shared by every line in the batch containing it.",
     )
     ver.add_argument(
         "-v", "--verbose", action="store_true", help="Print additional output text."
@@ -94,6 +194,10 @@ def main():
             f"{parser.prog}: error: cannot use -t/--targets with -f/--file. Use -s/--targets-file instead."
         )
         raise SystemExit()
+    if args.batch_size < 1:
+        parser.print_usage()
+        print(f"{parser.prog}: error: -b/--batch-size must be at least 1.")
+        raise SystemExit()
 
     # reading the input text and targets
     text_inp = []
@@ -106,18 +210,13 @@ def main():
             targ_inp.append(args.targets)
 
     elif args.file:
-        with open(args.file) as f:
-            r_text_inp = [
-                l for l in f.read().split("\n") if len(l.strip()) > 0 and l[0] != "#"
-            ]
+        r_text_inp = list(_iter_clean(args.file))
 
         if args.targets_file:
-            with open(args.targets_file) as f:
-                r_targ_inp = [
-                    [t.strip() for t in ts.split(",") if len(t.strip()) > 0]
-                    for ts in f.read().split("\n")
-                    if len(ts.strip()) > 0 and ts[0] != "#"
-                ]
+            r_targ_inp = [
+                tuple(t for t in (x.strip() for x in ts.split(",")) if t)
+                for ts in _iter_clean(args.targets_file)
+            ]
 
             if len(r_text_inp) != len(r_targ_inp):
                 print(
@@ -125,101 +224,501 @@ def main():
                 )
                 raise SystemError()
 
-            for i in range(len(r_text_inp)):
-                if len(r_text_inp[i].strip()) >= 1:
-                    text_inp.append(r_text_inp[i])
-                    targ_inp.append(r_targ_inp[i])
+            text_inp.extend(r_text_inp)
+            targ_inp.extend(r_targ_inp)
 
     # intialising the model (API connection)
     model = init_model()
+    cache = None if args.no_cache else open_cache()
 
-    # initialising the result list
-    results = {}
-    results["date"] = datetime.now()
-    results["batch"] = []
+    # each distinct (text, targets) pair is only analysed once
+    unique = {}
+    for text, targets in zip(text_inp, targ_inp):
+        key = (text, tuple(targets))
+        unique[key] = unique.get(key, 0) + 1
+    uniq_text = [text for text, _ in unique]
+    uniq_targ = [targets for _, targets in unique]
+    counts = list(unique.values())
 
-    # performing analysis
+    date = datetime.now()
+
+    # performing analysis, saving each result as soon as it arrives
     if not args.quiet:
         print()
-    for text, targets in zip(text_inp, targ_inp):
-        res = analyse(text, targets, model, args.language, args.verbose, args.quiet)
-        results["batch"].append(res)
-
-    # saving results
-    if not args.no_save:
-        if not args.quiet:
-            print("Saving...")
-        with open("out.json", "r") as f:
-            past = json.load(f)
-        past.append(results)
-        with open("out.json", "w") as f:
-            json.dump(past, f, default=str)
-        if not args.quiet:
-            print("Done.")
-
-
-def analyse(text, targets, model, language="en", verbose=False, quiet=False):
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor, (
+        nullcontext() if args.no_save else open(OUT_FILE, "ab")
+    ) as out:
+
+        def save(indices, batch_res):
+            if out is None:
+                return
+            for i, res in zip(indices, batch_res):
+                # the text is saved once, at the top level
+                res = {k: v for k, v in res.items() if k != "text"}
+                # datetimes are passed through to `default` so they are saved as str() gives them
+                line = orjson.dumps(
+                    {"date": date, "text": uniq_text[i], "res": res},
+                    default=str,
+                    option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_PASSTHROUGH_DATETIME,
+                )
+                out.write(line * counts[i])  # once for each time the row was given
+
+        if args.batch_size > 1:
+            batches = _coalesce(uniq_targ, args.batch_size)
+            tasks = (
+                analyse_batch_async(
+                    [uniq_text[i] for i in indices],
+                    targets,
+                    model,
+                    args.language,
+                    args.verbose,
+                    args.quiet,
+                    cache,
+                    args.direct,
+                    executor=executor,
+                )
+                for indices, targets in batches
+            )
+            asyncio.run(
+                _run_bounded(tasks, lambda j, batch_res: save(batches[j][0], batch_res))
+            )
+        else:
+            tasks = (
+                analyse_async(
+                    text,
+                    targets,
+                    model,
+                    args.language,
+                    args.verbose,
+                    args.quiet,
+                    cache,
+                    args.direct,
+                    executor=executor,
+                )
+                for text, targets in zip(uniq_text, uniq_targ)
+            )
+            asyncio.run(_run_bounded(tasks, lambda i, res: save([i], [res])))
+
+    if cache is not None:
+        cache.close()
+
+    if not args.no_save and not args.quiet:
+        print(f"Results saved to {OUT_FILE}.")
+
+
+def analyse(
+    text,
+    targets,
+    model,
+    language="en",
+    verbose=False,
+    quiet=False,
+    cache=None,
+    direct=False,
+):
     """Analyses the emotions in a given string as they relate to a list of targets using the Watson NLU API
 
     :param text: The text to analyse
     :type text: str
-    :param targets: List of targets to analyse, there must be at least one target which is in the text
-    :type targets: list
+    :param targets: List of targets to analyse; those not in the text are left out, and if none are the text is skipped without calling the API
+    :type targets: list or tuple
     :param model: The initialised :class:`ibm_watson.NaturalLanguageUnderstandingV1`, as the one returned by `init_model`
     :type model: class:`ibm_watson.NaturalLanguageUnderstandingV1`
     :param verbose: Whether to print usage and language statistics, defaults to False
     :type verbose: bool, optional
     :param quiet: Whether to silence printing of results, defaults to False
     :type quiet: bool, optional
-    :return: The result of the analysis, containing keys `"usage"`, `"language"`, `"emotion"`, and `"text"`
+    :param cache: The cache to look up and store results in, as returned by `open_cache`, or None to always call the API, defaults to None
+    :type cache: class:`sqlite3.Connection`, optional
+    :param direct: Whether to call the REST endpoint directly rather than through the SDK, defaults to False
+    :type direct: bool, optional
+    :return: The result of the analysis, containing keys `"usage"`, `"language"`, `"emotion"`, and `"text"`, or only `"text"` and `"skipped"` if no targets are in the text
+    :rtype: dict
+    """
+    # the API rejects texts which contain none of the targets, so checking first saves a call
+    targets = _present_targets(text, targets)
+    if not targets:
+        return _skip(text, quiet)
+
+    # the cached result is shared, so it is copied before being modified
+    res = dict(_analyse_cached(text, targets, model, language, cache, direct))
+    res["text"] = text
+
+    _print_result(res, targets, verbose, quiet)
+
+    return res
+
+
+def analyse_batch(
+    texts,
+    targets,
+    model,
+    language="en",
+    verbose=False,
+    quiet=False,
+    cache=None,
+    direct=False,
+):
+    """Analyses several strings which share the same targets in a single API call, then splits the result back up by line.
+
+    Each line gets the scores of the targets which appear in it. Since the API only sees the combined text, the document scores are for the whole batch and a target appearing in several lines has the same scores in each.
+
+    :param texts: The texts to analyse
+    :type texts: list
+    :param targets: List of targets to analyse; texts containing none of them are skipped, as in `analyse`
+    :type targets: list or tuple
+    :return: The result of the analysis of each text, in the same order as `texts`, as returned by `analyse`
+    :rtype: list
+
+    The remaining parameters are the same as for `analyse`.
+    """
+    results = {}
+    batch = []
+    batch_targets = set()
+    for i, text in enumerate(texts):
+        present = _present_targets(text, targets)
+        if present:
+            batch.append(i)
+            batch_targets.update(present)
+        else:
+            results[i] = _skip(text, quiet)
+
+    if len(batch) == 1:
+        i = batch[0]
+        results[i] = analyse(
+            texts[i], targets, model, language, verbose, quiet, cache, direct
+        )
+    elif batch:
+        batch_targets = tuple(t for t in targets if t in batch_targets)
+        res = _analyse_cached(
+            BATCH_SEPARATOR.join(texts[i] for i in batch),
+            batch_targets,
+            model,
+            language,
+            cache,
+            direct,
+        )
+        for i in batch:
+            results[i] = _split_result(res, texts[i], batch_targets, verbose, quiet)
+
+    return [results[i] for i in range(len(texts))]
+
+
+def _split_result(res, text, targets, verbose=False, quiet=False):
+    """Extracts the result for one line of a batch analysed by `analyse_batch`, and prints it.
+
+    :param res: The result of analysing the whole batch
+    :type res: dict
+    :param text: The line to extract the result for
+    :type text: str
+    :param targets: The targets the batch was analysed for
+    :type targets: tuple
+    :param verbose: Whether to print usage and language statistics, defaults to False
+    :type verbose: bool, optional
+    :param quiet: Whether to silence printing of results, defaults to False
+    :type quiet: bool, optional
+
+    :return: The result for the line, in the same form as returned by `analyse`
+    :rtype: dict
+    """
+    line_res = {k: v for k, v in res.items() if k != "emotion"}
+    line_res["emotion"] = {
+        "document": res["emotion"]["document"],
+        "targets": [t for t in res["emotion"]["targets"] if _mentions(text, t["text"])],
+    }
+    line_res["text"] = text
+
+    _print_result(line_res, targets, verbose, quiet, batch=True)
+
+    return line_res
+
+
+def _present_targets(text, targets):
+    """Finds which targets appear anywhere in a text, ignoring case. This is deliberately looser than `_mentions`, so that no text the API could analyse is skipped.
+
+    :param text: The text to search
+    :type text: str
+    :param targets: The targets to search for
+    :type targets: list or tuple
+
+    :return: The targets which appear in the text, in their original order
+    :rtype: tuple
+    """
+    folded = text.casefold()
+    return tuple(t for t in targets if t.casefold() in folded)
+
+
+def _mentions(text, target):
+    """Checks whether a target appears in a text as a whole word or phrase, ignoring case, so that e.g. "apples" is not found in "pineapples".
+
+    :param text: The text to search
+    :type text: str
+    :param target: The target to search for
+    :type target: str
+
+    :return: Whether the target appears in the text
+    :rtype: bool
+    """
+    # lookarounds rather than \b, so that targets starting or ending in punctuation still match
+    pattern = rf"(?<!\w){re.escape(target)}(?!\w)"
+    return re.search(pattern, text, re.IGNORECASE) is not None
+
+
+def _skip(text, quiet=False):
+    """Warns that a text is being skipped because none of its targets appear in it.
+
+    :param text: The text being skipped
+    :type text: str
+    :param quiet: Whether to silence the warning, defaults to False
+    :type quiet: bool, optional
+
+    :return: A placeholder result for the text, with keys `"text"` and `"skipped"`
     :rtype: dict
     """
     if not quiet:
-        print(f"Analysing: {text}")
-        print()
+        with _print_lock:
+            print(f"Skipping: {text}\n\nNone of the targets appear in the text.\n")
+
+    return {"text": text, "skipped": True}
+
+
+def _coalesce(targ_inp, batch_size):
+    """Groups input lines which have the same targets into batches.
+
+    :param targ_inp: The targets of each input line
+    :type targ_inp: list
+    :param batch_size: The maximum number of lines in a batch
+    :type batch_size: int
+
+    :return: A list of `(indices, targets)` pairs, where `indices` are the positions of the lines in the batch
+    :rtype: list
+    """
+    groups = {}
+    for i, targets in enumerate(targ_inp):
+        groups.setdefault(tuple(targets), []).append(i)
+
+    return [
+        (indices[start : start + batch_size], targets)
+        for targets, indices in groups.items()
+        for start in range(0, len(indices), batch_size)
+    ]
+
+
+@functools.lru_cache(maxsize=1024)
+def _analyse_cached(text, targets, model, language="en", cache=None, direct=False):
+    """Calls the API to analyse a text, reusing results from earlier in this run or stored in the on-disk cache. Takes the same parameters as `analyse`, except that `targets` must be a tuple so it can be hashed.
+
+    :return: The result of the analysis, containing keys `"usage"`, `"language"`, and `"emotion"`; it must not be modified
+    :rtype: dict
+    """
+    res = None
+    if cache is not None:  # checking for a previous result
+        key = _cache_key(text, targets, language)
+        with _cache_lock:
+            row = cache.execute("SELECT json FROM cache WHERE key=?", (key,)).fetchone()
+        if row is not None:
+            res = orjson.loads(row[0])
+
+    if res is None:  # performing analysis
+        if direct:
+            res = _analyse_direct(text, targets, model, language)
+        else:
+            res = model.analyze(
+                text=text, features=_features_for(targets), language=language
+            ).get_result()
+
+        if cache is not None:
+            with _cache_lock:
+                cache.execute(
+                    "INSERT OR REPLACE INTO cache (key, json) VALUES (?, ?)",
+                    (key, orjson.dumps(res).decode()),
+                )
+                cache.commit()
+
+    return res
+
+
+def _analyse_direct(text, targets, model, language="en"):
+    """Calls the analyse endpoint directly, skipping the SDK's request preparation and response handling. The model's connection pool and IAM token are reused.
+
+    :param text: The text to analyse
+    :type text: str
+    :param targets: The targets to analyse
+    :type targets: tuple
+    :param model: The initialised connection, as returned by `init_model`
+    :type model: class:`ibm_watson.NaturalLanguageUnderstandingV1`
+
+    :return: The result of the analysis, as returned by the API
+    :rtype: dict
+    """
+    token_manager = model.authenticator.token_manager
+    body = {
+        "text": text,
+        "features": _features_for(targets).to_dict(),
+        "language": language,
+    }
+
+    # the same request options as the SDK uses, so a stalled connection can't hang a worker
+    options = {"timeout": 60, **model.http_config}
+    if model.disable_ssl_verification:
+        options["verify"] = False
+
+    for attempt in range(2):
+        response = model.http_client.post(
+            f"{model.service_url}/v1/analyze",
+            params={"version": API_VERSION},
+            headers={"Authorization": f"Bearer {token_manager.get_token()}"},
+            json=body,
+            **options,
+        )
+        if response.status_code == 401 and attempt == 0:
+            token_manager.expire_time = 0  # forcing a new token to be fetched
+            continue
+        break
+
+    if not response.ok:
+        from ibm_cloud_sdk_core import ApiException
+
+        raise ApiException(response.status_code, http_response=response)
+
+    return orjson.loads(response.content)
+
 
-    # performing analysis
-    opts = nlu1.EmotionOptions(targets=targets)
-    res = model.analyze(
-        text=text, features=nlu1.Features(emotion=opts), language=language
-    ).get_result()
+@functools.lru_cache(maxsize=128)
+def _features_for(targets):
+    """Builds the features to request for a tuple of targets, reusing the same object for repeated targets.
+
+    :param targets: The targets to analyse
+    :type targets: tuple
+
+    :return: The features to pass to the API; it must not be modified
+    :rtype: class:`ibm_watson.natural_language_understanding_v1.Features`
+    """
+    import ibm_watson.natural_language_understanding_v1 as nlu1
+
+    return nlu1.Features(emotion=nlu1.EmotionOptions(targets=list(targets)))
+
+
+def _print_result(res, targets, verbose=False, quiet=False, batch=False):
+    """Prints the result of an analysis as a table of emotion scores. The output is written in one go, so that it is not interleaved with that of other threads.
+
+    :param res: The result of the analysis, as returned by `analyse`
+    :type res: dict
+    :param targets: The targets the text was analysed for
+    :type targets: list or tuple
+    :param verbose: Whether to print usage and language statistics, defaults to False
+    :type verbose: bool, optional
+    :param quiet: Whether to silence printing of results, defaults to False
+    :type quiet: bool, optional
+    :param batch: Whether the result is one line of a batch, in which case the usage is labelled as being for the whole batch, defaults to False
+    :type batch: bool, optional
+    """
+    buf = io.StringIO()
+
+    if not quiet:
+        print(f"Analysing: {res['text']}", file=buf)
+        print(file=buf)
 
     if verbose:  # printing extra information
         print(
-            f"Usage: {res['usage']['text_units']} units; {res['usage']['text_characters']} characters."
+            f"{'Batch usage' if batch else 'Usage'}: {res['usage']['text_units']} units; {res['usage']['text_characters']} characters.",
+            file=buf,
         )
-        print()
-        print(f"Language: {res['language']}")
-        print()
+        print(file=buf)
+        print(f"Language: {res['language']}", file=buf)
+        print(file=buf)
 
     if not quiet:  # printing emotion results
-        col_0_width = max(len(t) for t in targets + ["document"])
+        col_0_width = max(len(t) for t in [*targets, "document"])
 
-        print("Results")
-        print()
-        print(" | ".join(["item".ljust(col_0_width)] + [e.ljust(7) for e in EMOTIONS]))
-        print("-|-".join(["-" * col_0_width] + ["-" * 7 for _ in EMOTIONS]))
+        doc_emo = res["emotion"]["document"]["emotion"]
+        fmt = "{:.3f}".format
+
+        print("Results", file=buf)
+        print(file=buf)
+        print(" | ".join(["item".ljust(col_0_width)] + EMOTIONS_PADDED), file=buf)
+        print("-|-".join(["-" * col_0_width] + ["-" * 7 for _ in EMOTIONS]), file=buf)
         print(
             " | ".join(
                 ["document".ljust(col_0_width)]
-                + [
-                    f"{res['emotion']['document']['emotion'][e]:.3f}".ljust(7)
-                    for e in EMOTIONS
-                ]
-            )
+                + [fmt(doc_emo[e]).ljust(7) for e in EMOTIONS]
+            ),
+            file=buf,
         )
         for t in res["emotion"]["targets"]:
+            te = t["emotion"]
             print(
                 " | ".join(
                     [t["text"].ljust(col_0_width)]
-                    + [f"{t['emotion'][e]:.3f}".ljust(7) for e in EMOTIONS]
-                )
+                    + [fmt(te[e]).ljust(7) for e in EMOTIONS]
+                ),
+                file=buf,
             )
-        print()
+        print(file=buf)
 
-    res["text"] = text
+    with _print_lock:
+        print(buf.getvalue(), end="")
 
-    return res
+
+async def analyse_async(*args, executor=None, **kwargs):
+    """Runs `analyse` in a worker thread so that several API calls can be in flight at once. Takes the same parameters as `analyse`, plus:
+
+    :param executor: The thread pool to run `analyse` in or None to use the event loop's default, defaults to None
+    :type executor: class:`concurrent.futures.ThreadPoolExecutor`, optional
+
+    :return: The result of the analysis, as returned by `analyse`
+    :rtype: dict
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor, functools.partial(analyse, *args, **kwargs)
+    )
+
+
+async def analyse_batch_async(*args, executor=None, **kwargs):
+    """Runs `analyse_batch` in a worker thread, in the same way as `analyse_async`. Takes the same parameters as `analyse_batch`, plus `executor`.
+
+    :return: The results of the analyses, as returned by `analyse_batch`
+    :rtype: list
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor, functools.partial(analyse_batch, *args, **kwargs)
+    )
+
+
+async def _run_bounded(coros, on_result, limit=MAX_WORKERS):
+    """Awaits coroutines concurrently, with at most `limit` of them running at any one time. Each coroutine is only taken from `coros` once there is room for it, so only `limit` of them exist at once if `coros` is a generator.
+
+    :param coros: The coroutines to await
+    :type coros: Iterable
+    :param on_result: Function called with the index of each coroutine in `coros` and its result as soon as it finishes; the results are not kept
+    :type on_result: callable
+    :param limit: The maximum number of coroutines to run at once, defaults to MAX_WORKERS
+    :type limit: int, optional
+    """
+    running = {}  # task -> index in coros
+
+    async def wait_for_one():
+        done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+        # saving every successful result before raising, so that no finished call is lost
+        error = None
+        for task in done:
+            i = running.pop(task)
+            if task.exception() is not None:
+                error = error or task.exception()
+            else:
+                on_result(i, task.result())
+        if error is not None:
+            raise error
+
+    for i, coro in enumerate(coros):
+        if len(running) >= limit:
+            await wait_for_one()
+        running[asyncio.ensure_future(coro)] = i
+
+    while running:
+        await wait_for_one()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,37 @@
+import json
+import argparse
+
+
+def main():
+    """Main function; converts the results saved in an old-style out.json file (a single JSON list) to the out.jsonl format (one JSON object per analysed text)."""
+    parser = argparse.ArgumentParser(
+        description="Convert saved results from out.json to out.jsonl."
+    )
+    parser.add_argument(
+        "src", nargs="?", default="out.json", help="The out.json file to read."
+    )
+    parser.add_argument(
+        "dest",
+        nargs="?",
+        default="out.jsonl",
+        help="The out.jsonl file to append the results to.",
+    )
+    args = parser.parse_args()
+
+    with open(args.src) as f:
+        past = json.load(f)
+
+    # appending, so that results saved since switching to out.jsonl are kept
+    with open(args.dest, "a") as f:
+        for results in past:
+            for res in results["batch"]:
+                res = dict(res)
+                text = res.pop("text")
+                line = {"date": results["date"], "text": text, "res": res}
+                f.write(json.dumps(line, default=str) + "\n")
+
+    print(f"Converted {len(past)} runs from {args.src} to {args.dest}.")
+
+
+if __name__ == "__main__":
+    main()